@@ -7,27 +7,30 @@ from src.utils.load_trainers import load_trainer
 from src.utils.load_analysis import load_analysis
 
 
-if len(sys.argv) > 1:
-    configfname = sys.argv[1]
-else:
-    configfname = 'config.yaml'
+# Guarded so worker processes started with spawn (the default on macOS and
+# Windows) can import this file without rerunning the experiment
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        configfname = sys.argv[1]
+    else:
+        configfname = 'config.yaml'
 
-sys.stderr.write(f'Reading from {configfname}\n')
+    sys.stderr.write(f'Reading from {configfname}\n')
 
-with open(configfname, 'r') as f:
-    config = yaml.load(f, Loader=yaml.FullLoader)
+    with open(configfname, 'r') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
 
-modes = config['mode']
-for mode in modes:
-    if mode == 'interact':
-        exp = load_evaluation(config)
-        exp.interact()
-    if mode == 'evaluate':
-        exp = load_evaluation(config)
-        exp.evaluate()
-    if mode == 'train':
-        exp = load_trainer(config)
-        exp.train()
-    if mode == 'analyze':
-        exp = load_analysis(config)
-        exp.analyze()
+    modes = config['mode']
+    for mode in modes:
+        if mode == 'interact':
+            exp = load_evaluation(config)
+            exp.interact()
+        if mode == 'evaluate':
+            exp = load_evaluation(config)
+            exp.evaluate()
+        if mode == 'train':
+            exp = load_trainer(config)
+            exp.train()
+        if mode == 'analyze':
+            exp = load_analysis(config)
+            exp.analyze()
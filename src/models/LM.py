@@ -29,6 +29,7 @@ class LM:
         self.loadPretrained = True
         self.maxTrainSequenceLength = 128
         self.stride = None
+        self.packing = False
         for k, v in kwargs.items():
             setattr(self, k, v)
 
@@ -42,6 +42,11 @@ class HFCausalModel(LM):
         elif self.precision == '4bit':
             modelkwargs['load_in_4bit'] = True
 
+        # Packed (padding-free) training relies on FlashAttention2 to keep
+        # examples from attending to each other
+        if self.packing:
+            modelkwargs['attn_implementation'] = 'flash_attention_2'
+
         # If we are loading a new model to train, we need to grab the config
         if not self.loadPretrained:
             auto_config = AutoConfig.from_pretrained(
@@ -52,8 +57,12 @@ class HFCausalModel(LM):
                             bos_token_id = self.tokenizer.bos_token_id, 
                             eos_token_id = self.tokenizer.eos_token_id,
                         )
+            configkwargs = {}
+            if self.packing:
+                configkwargs['attn_implementation'] = 'flash_attention_2'
             self.model = \
-                    AutoModelForCausalLM.from_config(auto_config).to(self.device)
+                    AutoModelForCausalLM.from_config(auto_config,
+                                                **configkwargs).to(self.device)
         else:
             self.model = \
                     AutoModelForCausalLM.from_pretrained(**modelkwargs).to(self.device)
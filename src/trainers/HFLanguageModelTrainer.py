@@ -4,47 +4,96 @@
 # (https://github.com/forrestdavis)
 # August 2024
 from .Trainer import Trainer
-import datasets
 import transformers 
+import torch
 import sys
 import math
 
+# Model types whose FlashAttention2 implementation uses position_ids to keep
+# packed examples from attending to each other (as of transformers 4.44)
+PACKING_MODEL_TYPES = ['llama', 'mistral', 'mixtral', 'qwen2', 'qwen2_moe', 
+                       'phi3', 'starcoder2']
+
 class HFLanguageModelTrainer(Trainer): 
 
     def __init__(self, config: dict, 
                 **kwargs):
         super().__init__(config, **kwargs)
 
-
-    def tokenize_function(self, examples):
-        result = self.Model.tokenizer(examples[self.textLabel])
-        if self.wholeWordMasking:
-            result['word_ids'] = [result.word_ids(i) 
-                                  for i in range(len(result["input_ids"]))]
-        return result
-
-    def group_texts(self, examples):
-        concatenated_examples = {k: sum(examples[k], []) for k in
-                                examples.keys()}
-
-        total_length = len(concatenated_examples[list(examples.keys())[0]])
-        # Split by chunks of maxSequenceLength
-        result = {
-            k: [t[i : i + self.maxSequenceLength] for i in range(0,
-                                                                 total_length,
-                                                                 self.maxSequenceLength)]
-            for k, t in concatenated_examples.items()
-        }
-        return result
+        if self.packing:
+            if self.Model.isMaskedModel:
+                sys.stderr.write("Packing is only supported for causal "\
+                                 "language modeling, ignoring packing\n")
+                self.packing = False
+            elif self.Model.model.config.model_type not in \
+                    PACKING_MODEL_TYPES:
+                raise ValueError(f"Packing is not supported for "\
+                                 f"{self.Model.model.config.model_type} "\
+                                 f"models (supported: "\
+                                 f"{', '.join(PACKING_MODEL_TYPES)})")
+
+    def _make_preprocess(self):
+        """ Returns the functions that tokenize and chunk the dataset. The
+        settings they need are bound as locals so that dataset.map (with
+        num_proc) pickles only these rather than self (and its model). 
+
+        Returns:
+            `Tuple[Callable, Callable]`: tokenize_function and group_texts
+        """
+        tokenizer = self.Model.tokenizer
+        text_label = self.textLabel
+        max_sequence_length = self.maxSequenceLength
+        packing = self.packing
+        whole_word_masking = self.wholeWordMasking
+
+        def tokenize_function(examples):
+            if packing:
+                # Each example is kept whole (up to maxSequenceLength) 
+                # and packed by the collator instead of being chunked
+                result = tokenizer(examples[text_label], 
+                                   truncation=True, 
+                                   max_length=max_sequence_length)
+            else:
+                result = tokenizer(examples[text_label])
+            if whole_word_masking:
+                result['word_ids'] = [result.word_ids(i) 
+                                      for i in range(len(result["input_ids"]))]
+            return result
+
+        def group_texts(examples):
+            concatenated_examples = {k: sum(examples[k], []) for k in
+                                    examples.keys()}
+
+            total_length = len(concatenated_examples[list(examples.keys())[0]])
+            # Split by chunks of maxSequenceLength
+            result = {
+                k: [t[i : i + max_sequence_length] for i in range(0,
+                                                            total_length,
+                                                            max_sequence_length)]
+                for k, t in concatenated_examples.items()
+            }
+            return result
+
+        return tokenize_function, group_texts
 
     def preprocess_dataset(self):
+        tokenize_function, group_texts = self._make_preprocess()
         if self.verbose:
             sys.stderr.write("Tokenizing the dataset...\n")
-        self.dataset = self.dataset.map(self.tokenize_function, batched=True, 
-                                       remove_columns=[self.textLabel])
+        self.dataset = self.dataset.map(tokenize_function, batched=True, 
+                                       remove_columns=[self.textLabel], 
+                                       num_proc=self.num_proc)
+        if self.packing:
+            # The collator concatenates each batch into one sequence and 
+            # marks example boundaries with position_ids, so no attention 
+            # mask is needed
+            self.dataset = self.dataset.remove_columns(['attention_mask'])
+            self.data_collator = transformers.DataCollatorWithFlattening()
+            return
         if self.verbose:
             sys.stderr.write("Chunking the dataset...\n")
-        self.dataset = self.dataset.map(self.group_texts, batched=True)
+        self.dataset = self.dataset.map(group_texts, batched=True, 
+                                       num_proc=self.num_proc)
         self.data_collator = \
                     transformers.DataCollatorForLanguageModeling(
                         tokenizer=self.Model.tokenizer._tokenizer, 
@@ -61,23 +110,20 @@ class HFLanguageModelTrainer(Trainer):
             # Preprocess_dataset
             self.preprocess_dataset()
 
-        # Shuffle
-        self.dataset = self.dataset.shuffle(seed=42)
+        if self.torch_compile and self.Model.device.type == 'cuda':
+            # Allow tf32 matmuls (Ampere or newer) alongside compilation
+            torch.backends.cuda.matmul.allow_tf32 = True
 
         use_cpu = False
         if self.Model.device == 'cpu': 
             use_cpu = True
 
-        if self.precision == '16bit':
-            fp16 = True
-        else:
-            fp16 = False
-
         training_args = transformers.TrainingArguments(
             output_dir=self.modelfpath,
             learning_rate=self.learning_rate,
             per_device_train_batch_size=self.batchSize,
             per_device_eval_batch_size=self.batchSize,
+            gradient_accumulation_steps=self.gradient_accumulation_steps,
             num_train_epochs=self.epochs,
             weight_decay=self.weight_decay,
             eval_strategy=self.eval_strategy,
@@ -86,7 +132,23 @@ class HFLanguageModelTrainer(Trainer):
             save_steps=self.save_steps,
             load_best_model_at_end=self.load_best_model_at_end,
             use_cpu=use_cpu,
-            fp16=fp16,
+            # The Trainer's sampler shuffles each epoch
+            seed=42,
+            data_seed=42,
+            dataloader_num_workers=self.dataloader_num_workers,
+            dataloader_persistent_workers=self.dataloader_num_workers > 0,
+            dataloader_prefetch_factor=4 if self.dataloader_num_workers > 0 
+                                         else None,
+            dataloader_pin_memory=True,
+            fp16=self.fp16,
+            bf16=self.bf16,
+            gradient_checkpointing=self.gradient_checkpointing,
+            gradient_checkpointing_kwargs={'use_reentrant': False},
+            torch_compile=self.torch_compile,
+            torch_compile_backend='inductor' if self.torch_compile else None,
+            ddp_backend='nccl' if self.use_ddp else None,
+            ddp_find_unused_parameters=False,
+            ddp_bucket_cap_mb=25,
             )
 
         trainer = transformers.Trainer(
@@ -6,34 +6,16 @@
 from .Trainer import Trainer
 import datasets
 import transformers 
+import torch
 import sys
+import os
 
-import numpy as np
-import evaluate
-
-# Load metrics
-accuracy = evaluate.load("accuracy")
-precision = evaluate.load('precision')
-recall = evaluate.load('recall')
-f1 = evaluate.load('f1')
+from ._metrics import preprocess_logits_for_metrics, weighted_metrics
 
 def compute_metrics(eval_pred):
+    # Predictions are already label ids (see preprocess_logits_for_metrics)
     predictions, labels = eval_pred
-    predictions = np.argmax(predictions, axis=-1)
-
-    acc = accuracy.compute(predictions=predictions, references=labels)
-    p = precision.compute(predictions=predictions, 
-                                    references=labels,
-                                    average='weighted', 
-                                    zero_division=0)
-    r = recall.compute(predictions=predictions, 
-                                    references=labels,
-                                    average='weighted', 
-                                    zero_division=0)
-    f = f1.compute(predictions=predictions, 
-                                    references=labels,
-                                    average='weighted')
-    return {**acc, **p, **r, **f}
+    return weighted_metrics(predictions, labels)
 
 class HFTextClassificationTrainer(Trainer): 
 
@@ -41,39 +23,66 @@ class HFTextClassificationTrainer(Trainer):
                 **kwargs):
         super().__init__(config, **kwargs)
 
-    def preprocess_function(self, examples):
-
-        if self.pairLabel in examples:
-            pairs = examples[self.pairLabel]
-        else:
-            pairs = None
-
-        tokenized_inputs = self.Model.tokenizer(examples[self.textLabel],
-                                    pairs, truncation=True)
-        # Update labels if not ints
-        labels = []
-        for label in examples['label']:
-            if not isinstance(label, int):
-                if label not in self.Model.label2id:
-                    sys.stderr.write(f"The labels must be ints. You can add "\
-                                     "mappings via id2label in the config\n")
-                labels.append(self.Model.label2id[label])
+    def _make_preprocess(self):
+        """ Returns a function that tokenizes input and maps labels to ids.
+        The settings it needs are bound as locals so the function does not
+        look them up on self (or pickle self) for each batch. """
+        tokenizer = self.Model.tokenizer
+        text_label = self.textLabel
+        pair_label = self.pairLabel
+        l2i = self.Model.label2id
+
+        def preprocess_function(examples):
+            if pair_label in examples:
+                pairs = examples[pair_label]
             else:
-                labels.append(label)
-        tokenized_inputs['label'] = labels
-
-        return tokenized_inputs
+                pairs = None
+
+            # Padding is left to the collator and the lengths are used to
+            # bucket similar length examples (group_by_length)
+            tokenized_inputs = tokenizer(examples[text_label],
+                                         pairs, truncation=True, 
+                                         padding=False, 
+                                         return_length=True)
+            # Update labels if not ints
+            try:
+                labels = [label if isinstance(label, int) else l2i[label] 
+                          for label in examples['label']]
+            except KeyError:
+                sys.stderr.write(f"The labels must be ints. You can add "\
+                                 "mappings via id2label in the config\n")
+                raise
+            tokenized_inputs['label'] = labels
+
+            return tokenized_inputs
+
+        return preprocess_function
 
     def preprocess_dataset(self):
         if self.dataset is None:
             self.set_dataset()
 
-        if self.verbose:
-            sys.stderr.write("Tokenizing the dataset...\n")
-        self.dataset = self.dataset.map(self.preprocess_function, batched=True)
+        # Reuse the tokenized dataset from a previous run if cached
+        cache_path = self.get_cache_path()
+        if cache_path is not None and os.path.isdir(cache_path):
+            if self.verbose:
+                sys.stderr.write(f"Loading the tokenized dataset from "\
+                                 f"{cache_path}...\n")
+            self.dataset = datasets.load_from_disk(cache_path)
+        else:
+            if self.verbose:
+                sys.stderr.write("Tokenizing the dataset...\n")
+            self.dataset = self.dataset.map(self._make_preprocess(), 
+                                            batched=True, 
+                                            num_proc=self.num_proc)
+            if cache_path is not None:
+                self.save_cached_dataset(cache_path)
         self.data_collator = \
                     transformers.DataCollatorWithPadding(
-                        tokenizer=self.Model.tokenizer._tokenizer)
+                        tokenizer=self.Model.tokenizer._tokenizer, 
+                        # Align padded lengths with tensor core tiles 
+                        pad_to_multiple_of=8 if self.fp16 or self.bf16 
+                                             else None)
     def train(self):
 
         if self.dataset is None:
@@ -84,8 +93,9 @@ class HFTextClassificationTrainer(Trainer):
             # Preprocess_dataset
             self.preprocess_dataset()
 
-        # Shuffle
-        self.dataset = self.dataset.shuffle(seed=42)
+        if self.torch_compile and self.Model.device.type == 'cuda':
+            # Allow tf32 matmuls (Ampere or newer) alongside compilation
+            torch.backends.cuda.matmul.allow_tf32 = True
 
         use_cpu = False
         if str(self.Model.device) == 'cpu': 
@@ -96,6 +106,7 @@ class HFTextClassificationTrainer(Trainer):
             learning_rate=self.learning_rate,
             per_device_train_batch_size=self.batchSize,
             per_device_eval_batch_size=self.batchSize,
+            gradient_accumulation_steps=self.gradient_accumulation_steps,
             num_train_epochs=self.epochs,
             weight_decay=self.weight_decay,
             eval_strategy=self.eval_strategy,
@@ -104,6 +115,25 @@ class HFTextClassificationTrainer(Trainer):
             save_steps=self.save_steps,
             load_best_model_at_end=self.load_best_model_at_end,
             use_cpu=use_cpu,
+            # The Trainer's sampler shuffles each epoch
+            seed=42,
+            data_seed=42,
+            dataloader_num_workers=self.dataloader_num_workers,
+            dataloader_persistent_workers=self.dataloader_num_workers > 0,
+            dataloader_prefetch_factor=4 if self.dataloader_num_workers > 0 
+                                         else None,
+            dataloader_pin_memory=True,
+            fp16=self.fp16,
+            bf16=self.bf16,
+            gradient_checkpointing=self.gradient_checkpointing,
+            gradient_checkpointing_kwargs={'use_reentrant': False},
+            torch_compile=self.torch_compile,
+            torch_compile_backend='inductor' if self.torch_compile else None,
+            ddp_backend='nccl' if self.use_ddp else None,
+            ddp_find_unused_parameters=False,
+            ddp_bucket_cap_mb=25,
+            group_by_length=self.group_by_length,
+            length_column_name='length',
             )
 
         trainer = transformers.Trainer(
@@ -114,6 +144,7 @@ class HFTextClassificationTrainer(Trainer):
                 tokenizer=self.Model.tokenizer._tokenizer, 
                 data_collator = self.data_collator, 
                 compute_metrics = compute_metrics,
+                preprocess_logits_for_metrics = preprocess_logits_for_metrics,
             )
         trainer.train()
         if self.verbose: 
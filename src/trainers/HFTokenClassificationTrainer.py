@@ -6,42 +6,20 @@
 from .Trainer import Trainer
 import datasets
 import transformers 
+import torch
 import sys
+import os
+import itertools
 
 import numpy as np
-import evaluate
-
-# Load metrics
-accuracy = evaluate.load("accuracy")
-precision = evaluate.load('precision')
-recall = evaluate.load('recall')
-f1 = evaluate.load('f1')
+from ._metrics import preprocess_logits_for_metrics, weighted_metrics
 
 def compute_metrics(eval_pred):
+    # Predictions are already label ids (see preprocess_logits_for_metrics)
     predictions, labels = eval_pred
-    predictions = np.argmax(predictions, axis=-1)
-    true_predictions = []
-    true_labels = []
-    for prediction, label in zip(predictions, labels):
-        for p, l in zip(prediction, label):
-            if l != -100:
-                true_predictions.append(p)
-                true_labels.append(l)
-    predictions = true_predictions
-    labels = true_labels
-    acc = accuracy.compute(predictions=predictions, references=labels)
-    p = precision.compute(predictions=predictions, 
-                                    references=labels,
-                                    average='weighted', 
-                                    zero_division=0)
-    r = recall.compute(predictions=predictions, 
-                                    references=labels,
-                                    average='weighted', 
-                                    zero_division=0)
-    f = f1.compute(predictions=predictions, 
-                                    references=labels,
-                                    average='weighted')
-    return {**acc, **p, **r, **f}
+    # Drop special tokens and non-initial subwords (flattens to 1D)
+    mask = labels != -100
+    return weighted_metrics(predictions[mask], labels[mask])
 
 class HFTokenClassificationTrainer(Trainer): 
 
@@ -49,51 +27,82 @@ class HFTokenClassificationTrainer(Trainer):
                 **kwargs):
         super().__init__(config, **kwargs)
 
-    def preprocess_function(self, examples):
-        """ Tokenizes input and aligns tokens with token level labels accounting
-        for split words. """
+    def _make_preprocess(self):
+        """ Returns a function that tokenizes input and aligns tokens with
+        token level labels accounting for split words. The settings it needs
+        are bound as locals so the function does not look them up on self
+        (or pickle self) for each batch. """
         # Adapted from HuggingFace's Token Classification Guide
-        if self.pairLabel in examples:
-            pairs = examples[self.pairLabel]
-        else:
-            pairs = None
-
-        tokenized_inputs = self.Model.tokenizer(examples[self.tokensLabel],
-                                                pairs,
-                                                truncation=True,
-                                                is_split_into_words=True)
-        labels = []
-        for i, label in enumerate(examples[self.tagsLabel]):
-            word_ids = tokenized_inputs.word_ids(batch_index=i)
-            previous_word_idx = None
-            label_ids = []
-            for word_idx in word_ids:
-                if word_idx is None:
-                    label_ids.append(-100)
-                elif word_idx != previous_word_idx:
-                    word_label = label[word_idx]
-                    # Update label if not an int
-                    if not isinstance(word_label, int):
-                        if word_label not in self.Model.label2id:
-                            sys.stderr.write(f"The labels must be ints. "\
-                                             "You can add mappings via "\
-                                             "id2label in the config\n")
-                        word_label = self.Model.label2id[word_label]
-                    label_ids.append(word_label)
-                else:
-                    label_ids.append(-100)
-                previous_word_idx = word_idx
-            labels.append(label_ids)
-        tokenized_inputs['labels'] = labels
-        return tokenized_inputs
+        tokenizer = self.Model.tokenizer
+        pair_label = self.pairLabel
+        tokens_label = self.tokensLabel
+        tags_label = self.tagsLabel
+        l2i = self.Model.label2id
+
+        def preprocess_function(examples):
+            if pair_label in examples:
+                pairs = examples[pair_label]
+            else:
+                pairs = None
+
+            # Padding is left to the collator and the lengths are used to
+            # bucket similar length examples (group_by_length)
+            tokenized_inputs = tokenizer(examples[tokens_label],
+                                         pairs,
+                                         truncation=True,
+                                         padding=False,
+                                         is_split_into_words=True, 
+                                         return_length=True)
+            labels = []
+            for i, label in enumerate(examples[tags_label]):
+                # Update labels if not ints, with a trailing -100 so that 
+                # special tokens (word id -1) index it
+                try:
+                    label = np.fromiter(itertools.chain(
+                                (l if isinstance(l, int) else l2i[l] 
+                                 for l in label), (-100,)), 
+                                dtype=np.int64, count=len(label)+1)
+                except KeyError:
+                    sys.stderr.write(f"The labels must be ints. "\
+                                     "You can add mappings via "\
+                                     "id2label in the config\n")
+                    raise
+                word_ids = np.array([-1 if word_idx is None else word_idx 
+                                     for word_idx in 
+                                     tokenized_inputs.word_ids(batch_index=i)], 
+                                    dtype=np.int64)
+                # Only label the first token of each word
+                first = np.concatenate(([True], 
+                                        word_ids[1:] != word_ids[:-1]))
+                label_ids = np.where(first, label[word_ids], -100)
+                labels.append(label_ids.tolist())
+            tokenized_inputs['labels'] = labels
+            return tokenized_inputs
+
+        return preprocess_function
 
     def preprocess_dataset(self):
-        if self.verbose:
-            sys.stderr.write("Tokenizing the dataset...\n")
-        self.dataset = self.dataset.map(self.preprocess_function, batched=True)
+        # Reuse the tokenized dataset from a previous run if cached
+        cache_path = self.get_cache_path()
+        if cache_path is not None and os.path.isdir(cache_path):
+            if self.verbose:
+                sys.stderr.write(f"Loading the tokenized dataset from "\
+                                 f"{cache_path}...\n")
+            self.dataset = datasets.load_from_disk(cache_path)
+        else:
+            if self.verbose:
+                sys.stderr.write("Tokenizing the dataset...\n")
+            self.dataset = self.dataset.map(self._make_preprocess(), 
+                                            batched=True, 
+                                            num_proc=self.num_proc)
+            if cache_path is not None:
+                self.save_cached_dataset(cache_path)
         self.data_collator = \
                     transformers.DataCollatorForTokenClassification(
-                        tokenizer=self.Model.tokenizer._tokenizer)
+                        tokenizer=self.Model.tokenizer._tokenizer, 
+                        # Align padded lengths with tensor core tiles 
+                        pad_to_multiple_of=8 if self.fp16 or self.bf16 
+                                             else None)
 
     def train(self):
 
@@ -105,8 +114,9 @@ class HFTokenClassificationTrainer(Trainer):
             # Preprocess_dataset
             self.preprocess_dataset()
 
-        # Shuffle
-        self.dataset = self.dataset.shuffle(seed=42)
+        if self.torch_compile and self.Model.device.type == 'cuda':
+            # Allow tf32 matmuls (Ampere or newer) alongside compilation
+            torch.backends.cuda.matmul.allow_tf32 = True
 
         use_cpu = False
         if str(self.Model.device) == 'cpu': 
@@ -117,6 +127,7 @@ class HFTokenClassificationTrainer(Trainer):
             learning_rate=self.learning_rate,
             per_device_train_batch_size=self.batchSize,
             per_device_eval_batch_size=self.batchSize,
+            gradient_accumulation_steps=self.gradient_accumulation_steps,
             num_train_epochs=self.epochs,
             weight_decay=self.weight_decay,
             eval_strategy=self.eval_strategy,
@@ -125,6 +136,25 @@ class HFTokenClassificationTrainer(Trainer):
             save_steps=self.save_steps,
             load_best_model_at_end=self.load_best_model_at_end,
             use_cpu=use_cpu,
+            # The Trainer's sampler shuffles each epoch
+            seed=42,
+            data_seed=42,
+            dataloader_num_workers=self.dataloader_num_workers,
+            dataloader_persistent_workers=self.dataloader_num_workers > 0,
+            dataloader_prefetch_factor=4 if self.dataloader_num_workers > 0 
+                                         else None,
+            dataloader_pin_memory=True,
+            fp16=self.fp16,
+            bf16=self.bf16,
+            gradient_checkpointing=self.gradient_checkpointing,
+            gradient_checkpointing_kwargs={'use_reentrant': False},
+            torch_compile=self.torch_compile,
+            torch_compile_backend='inductor' if self.torch_compile else None,
+            ddp_backend='nccl' if self.use_ddp else None,
+            ddp_find_unused_parameters=False,
+            ddp_bucket_cap_mb=25,
+            group_by_length=self.group_by_length,
+            length_column_name='length',
             )
 
         trainer = transformers.Trainer(
@@ -135,6 +165,7 @@ class HFTokenClassificationTrainer(Trainer):
                 tokenizer=self.Model.tokenizer._tokenizer, 
                 data_collator = self.data_collator, 
                 compute_metrics = compute_metrics,
+                preprocess_logits_for_metrics = preprocess_logits_for_metrics,
             )
         trainer.train()
         if self.verbose: 
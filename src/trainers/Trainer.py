@@ -9,6 +9,9 @@ from typing import Union, Dict, List, Tuple, Optional
 import sys
 import datasets
 import random
+import os
+import hashlib
+import shutil
 
 class Trainer:
 
@@ -19,6 +22,7 @@ class Trainer:
         self.trainfpath = None
         self.validfpath = None
         self.modelfpath = None
+        self.cachefpath = None
         self.verbose = True
 
         # Dataset defaults
@@ -29,13 +33,20 @@ class Trainer:
         self.tokensLabel = 'tokens'
         self.tagsLabel = 'tags'
         self.dataset = None
+        self.num_proc = None
+        self.dataloader_num_workers = None
 
         # Training defaults
         self.precision = None
+        self.fp16 = None
+        self.bf16 = None
+        self.torch_compile = False
+        self.gradient_checkpointing = False
         self.epochs = 2
         self.eval_strategy = 'epoch'
         self.eval_steps = 500
         self.batchSize = 16
+        self.gradient_accumulation_steps = 1
         self.learning_rate = 5e-5
         self.weight_decay = 0.01
         self.save_strategy = 'epoch'
@@ -44,6 +55,8 @@ class Trainer:
         self.wholeWordMasking = False
         self.maskProbability = 0.15
         self.maxSequenceLength = 128
+        self.packing = False
+        self.group_by_length = True
 
         for k, v in kwargs.items():
             setattr(self, k, v)
@@ -55,6 +68,8 @@ class Trainer:
             self.validfpath = config['validfpath']
         if 'modelfpath' in config:
             self.modelfpath = config['modelfpath']
+        if 'cachefpath' in config:
+            self.cachefpath = config['cachefpath']
 
         # Set up model
         config = {**config, **kwargs}
@@ -65,9 +80,48 @@ class Trainer:
         assert self.modelfpath is not None, "Must pass a modelfpath" \
                                     " for saving the final model"
 
+        # Tokenize with all available cores by default
+        if self.num_proc is None:
+            self.num_proc = os.cpu_count()
+
+        # Collate batches in background workers by default
+        if self.dataloader_num_workers is None:
+            self.dataloader_num_workers = min(8, os.cpu_count()//2)
+
+        # Multiple GPUs are trained with DistributedDataParallel, which 
+        # requires launching with torchrun (otherwise HuggingFace falls 
+        # back to the slower DataParallel)
+        self.use_ddp = False
+        if torch.cuda.device_count() > 1:
+            if 'LOCAL_RANK' in os.environ:
+                self.use_ddp = True
+            else:
+                sys.stderr.write("Multiple GPUs found. To train with "\
+                                 "DistributedDataParallel launch with "\
+                                 "torchrun --nproc_per_node=N main.py "\
+                                 "config.yaml\n")
+
+        self.set_mixed_precision()
+
         self.data_collator = None
         self.evaluator = None
 
+    def set_mixed_precision(self):
+        """ Sets the defaults for self.fp16 and self.bf16 (if not given in
+        the config). Mixed precision is only used for full precision weights
+        on a GPU: bf16 when the GPU supports it natively (not emulated, e.g.,
+        on T4 or V100) and fp16 otherwise. Models loaded with a lower
+        precision (16bit, 8bit, 4bit) are trained without mixed precision,
+        since the gradient scaler cannot unscale fp16 gradients. 
+        """
+        use_amp = (self.Model.device.type == 'cuda' and 
+                   self.precision not in ('16bit', '8bit', '4bit'))
+        if self.bf16 is None:
+            self.bf16 = use_amp and torch.cuda.is_bf16_supported(
+                                                including_emulation=False)
+        if self.fp16 is None:
+            self.fp16 = use_amp and not self.bf16
+
     def load_train_valid(self) -> Tuple[datasets.Dataset, datasets.Dataset]:
         """ Load the training and validation data as hf datasets. 
         
@@ -175,6 +229,46 @@ class Trainer:
         self.dataset = datasets.DatasetDict({'train': train, 'valid':
                                              valid})
 
+    def get_cache_path(self) -> Optional[str]:
+        """ Returns the directory for caching the preprocessed dataset, keyed
+        by the tokenizer, the raw dataset, and the preprocessing settings. 
+
+        Returns:
+            `Optional[str]`: Path of the cached dataset (None if no cachefpath
+                            was specified)
+        """
+        if self.cachefpath is None:
+            return None
+        key = [type(self).__name__, str(self.Model.tokenizer), 
+               str(getattr(self.Model.tokenizer, 'doLower', None)),
+               str(getattr(self.Model.tokenizer, 'addPrefixSpace', None)),
+               str(self.maxSequenceLength), self.textLabel, self.pairLabel, 
+               self.tokensLabel, self.tagsLabel, 
+               str(getattr(self.Model, 'label2id', None))]
+        key.extend(self.dataset[split]._fingerprint for split in self.dataset)
+        fingerprint = hashlib.md5(' '.join(key).encode()).hexdigest()
+        return os.path.join(self.cachefpath, fingerprint)
+
+    def save_cached_dataset(self, cache_path: str):
+        """ Saves the preprocessed dataset to cache_path. The dataset is
+        written to a temporary sibling directory and then moved into place, so
+        an interrupted save never leaves a partial cache behind. Only the main
+        process saves when training with multiple processes. 
+
+        Args:
+            cache_path (`str`): Path to save the dataset to (see
+                                get_cache_path)
+        """
+        if int(os.environ.get('LOCAL_RANK', 0)) != 0:
+            return
+        tmp_path = f"{cache_path}.tmp{os.getpid()}"
+        self.dataset.save_to_disk(tmp_path)
+        try:
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            # Another run already cached this dataset
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
     def show_k_samples(self, k: int = 5): 
         """ Print k samples from the training data. 
 
@@ -219,6 +313,9 @@ class Trainer:
                                 The default is 500. 
             `self.batchSize`: The per-device batch size for train/eval. The
                                 default is 8. 
+            `self.gradient_accumulation_steps`: Number of batches to
+                                accumulate gradients over before each update.
+                                The default is 1. 
             `self.learning_rate`: The initial learning rate for AdamW. Default
                                     is 5e-5. 
             `self.weight_decay`: Weight decay. The default is 0.01.
@@ -231,5 +328,31 @@ class Trainer:
                             be saved as the model at the end. Default is False.
             `self.maskProbability`: The rate of dynamic masking for masked
                             language modeling. The default is 0.15. 
+            `self.num_proc`: Number of processes used to tokenize the dataset.
+                            The default is the number of available cpus. 
+            `self.dataloader_num_workers`: Number of worker processes that
+                            load and collate batches during training. The
+                            default is half the available cpus (at most 8). 
+            `self.fp16`: Whether to use fp16 mixed precision training. The
+                            default is True when training a full precision
+                            model on a GPU without bf16 support and False
+                            otherwise. 
+            `self.bf16`: Whether to use bf16 mixed precision training. The
+                            default is True when training a full precision
+                            model on a GPU that supports it and False
+                            otherwise. 
+            `self.gradient_checkpointing`: Whether to recompute activations
+                            in the backward pass to save memory (helpful
+                            for large models). The default is False. 
+            `self.torch_compile`: Whether to compile the model with
+                            torch.compile (and allow tf32 matmuls on a GPU).
+                            Requires Triton, which is not available on
+                            Windows. The default is False. 
+            `self.group_by_length`: Whether to batch together examples of
+                            similar length to reduce padding (text and token
+                            classification only). The default is True.
+            `self.packing`: Whether to pack examples into a single padding-free
+                            sequence with FlashAttention2 (causal language
+                            modeling only). The default is False.
         """
         raise NotImplementedError
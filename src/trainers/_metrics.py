@@ -0,0 +1,32 @@
+# Evaluation metrics shared by the text and token classification trainers
+import torch
+import numpy as np
+
+def preprocess_logits_for_metrics(logits, labels):
+    """ Reduces logits to predicted label ids on device, so evaluation only
+    accumulates int32 ids rather than full logits. """
+    if isinstance(logits, tuple):
+        logits = logits[0]
+    return logits.argmax(dim=-1).to(torch.int32)
+
+def weighted_metrics(predictions: np.ndarray, labels: np.ndarray) -> dict:
+    """ Returns accuracy and weighted precision, recall, and f1. 
+
+    Args:
+        predictions (`np.ndarray`): Predicted label ids
+        labels (`np.ndarray`): Gold label ids (same shape as predictions)
+
+    Returns:
+        `dict`: Dictionary with accuracy, precision, recall, and f1
+    """
+    # Imported here so importing the trainers (and forking workers) 
+    # does not pay for sklearn until evaluation
+    from sklearn.metrics import precision_recall_fscore_support
+
+    # One pass for precision, recall, and f1
+    p, r, f, _ = precision_recall_fscore_support(labels, predictions, 
+                                                 average='weighted', 
+                                                 zero_division=0)
+    acc = np.mean(predictions == labels)
+    return {'accuracy': float(acc), 'precision': float(p), 
+            'recall': float(r), 'f1': float(f)}
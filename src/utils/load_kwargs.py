@@ -16,12 +16,16 @@ def load_kwargs(config: dict) -> dict:
                 'pairLabel',
                 'tokensLabel',
                 'tagsLabel',
+                'num_proc',
+                'dataloader_num_workers',
                 # training args
                 'modelfpath',
+                'cachefpath',
                 'epochs',
                 'eval_strategy',
                 'eval_steps',
                 'batchSize',
+                'gradient_accumulation_steps',
                 'learning_rate',
                 'weight_decay',
                 'save_strategy',
@@ -30,6 +34,12 @@ def load_kwargs(config: dict) -> dict:
                 'wholeWordMasking',
                 'maskProbability',
                 'maxTrainSequenceLength',
+                'packing',
+                'group_by_length',
+                'fp16',
+                'bf16',
+                'torch_compile',
+                'gradient_checkpointing',
                 # analysis args
                 'predfpath',
                 'datafpath',
@@ -0,0 +1,64 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+import numpy as np
+import torch
+from sklearn.metrics import (accuracy_score, precision_score, recall_score,
+                             f1_score)
+from src.trainers._metrics import (weighted_metrics,
+                                   preprocess_logits_for_metrics)
+from src.trainers.HFTokenClassificationTrainer import \
+        compute_metrics as token_compute_metrics
+
+def expected_metrics(predictions, labels):
+    """ The separate per-metric computation weighted_metrics replaced. """
+    return {'accuracy': accuracy_score(labels, predictions),
+            'precision': precision_score(labels, predictions,
+                                         average='weighted',
+                                         zero_division=0),
+            'recall': recall_score(labels, predictions, average='weighted',
+                                   zero_division=0),
+            'f1': f1_score(labels, predictions, average='weighted',
+                           zero_division=0)}
+
+def assert_close(output, expected):
+    assert output.keys() == expected.keys()
+    for k in expected:
+        assert np.isclose(output[k], expected[k]), k
+
+def test_weighted_metrics():
+    rng = np.random.default_rng(23)
+    labels = rng.integers(0, 4, size=200)
+    predictions = rng.integers(0, 4, size=200)
+    assert_close(weighted_metrics(predictions, labels),
+                 expected_metrics(predictions, labels))
+
+def test_weighted_metrics_missing_class():
+    # Class 2 is never predicted (zero_division)
+    labels = np.array([0, 1, 2, 2, 1])
+    predictions = np.array([0, 1, 1, 0, 1])
+    assert_close(weighted_metrics(predictions, labels),
+                 expected_metrics(predictions, labels))
+
+def test_token_compute_metrics_masks_ignored():
+    labels = np.array([[-100, 1, 2, -100, -100],
+                       [-100, 0, -100, 1, -100]])
+    # Values at ignored positions must not count
+    predictions = np.array([[3, 1, 1, 3, -100],
+                            [3, 0, 3, 1, -100]], dtype=np.int32)
+    assert_close(token_compute_metrics((predictions, labels)),
+                 expected_metrics([1, 1, 0, 1], [1, 2, 0, 1]))
+
+def test_preprocess_logits_for_metrics():
+    logits = torch.tensor([[[0.1, 2.0, -1.0], [3.0, 0.0, 0.5]]],
+                          dtype=torch.float32)
+    predictions = preprocess_logits_for_metrics((logits,), None)
+    assert predictions.dtype == torch.int32
+    assert predictions.tolist() == [[1, 0]]
+
+if __name__ == '__main__':
+    test_weighted_metrics()
+    test_weighted_metrics_missing_class()
+    test_token_compute_metrics_masks_ignored()
+    test_preprocess_logits_for_metrics()
+    print('ok')
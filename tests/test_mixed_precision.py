@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+from types import SimpleNamespace
+from unittest import mock
+import torch
+from src.trainers.Trainer import Trainer
+
+def resolve(device, precision=None, bf16_supported=True, **kwargs):
+    """ Returns (fp16, bf16) as set by set_mixed_precision (no model is
+    loaded and bf16 support is faked so this runs without a GPU). """
+    trainer = Trainer.__new__(Trainer)
+    trainer.Model = SimpleNamespace(device=torch.device(device))
+    trainer.precision = precision
+    trainer.fp16 = kwargs.get('fp16')
+    trainer.bf16 = kwargs.get('bf16')
+    with mock.patch('torch.cuda.is_bf16_supported',
+                    return_value=bf16_supported):
+        trainer.set_mixed_precision()
+    return trainer.fp16, trainer.bf16
+
+def test_full_precision_gpu():
+    assert resolve('cuda') == (False, True)
+    # e.g., T4 or V100
+    assert resolve('cuda', bf16_supported=False) == (True, False)
+    assert resolve('cuda', precision='full') == (False, True)
+
+def test_lower_precision_gpu():
+    # fp16 weights cannot be trained with the fp16 gradient scaler
+    for precision in ['16bit', '8bit', '4bit']:
+        assert resolve('cuda', precision=precision) == (False, False)
+        assert resolve('cuda', precision=precision,
+                       bf16_supported=False) == (False, False)
+
+def test_no_gpu():
+    assert resolve('cpu') == (False, False)
+    assert resolve('mps') == (False, False)
+
+def test_config_overrides():
+    assert resolve('cuda', fp16=True, bf16=False) == (True, False)
+    assert resolve('cpu', bf16=True) == (False, True)
+
+if __name__ == '__main__':
+    test_full_precision_gpu()
+    test_lower_precision_gpu()
+    test_no_gpu()
+    test_config_overrides()
+    print('ok')
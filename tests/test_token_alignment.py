@@ -0,0 +1,77 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+from types import SimpleNamespace
+from src.tokenizers.hf_tokenizer import HFTokenizer
+from src.trainers.HFTokenClassificationTrainer import \
+        HFTokenClassificationTrainer
+
+label2id = {'O': 0, 'NOUN': 1, 'VERB': 2, 'PROPN': 3}
+
+def loop_alignment(tokenized_inputs, tags):
+    """ The original per-token loop the NumPy alignment replaced. """
+    labels = []
+    for i, label in enumerate(tags):
+        word_ids = tokenized_inputs.word_ids(batch_index=i)
+        previous_word_idx = None
+        label_ids = []
+        for word_idx in word_ids:
+            if word_idx is None:
+                label_ids.append(-100)
+            elif word_idx != previous_word_idx:
+                word_label = label[word_idx]
+                if not isinstance(word_label, int):
+                    word_label = label2id[word_label]
+                label_ids.append(word_label)
+            else:
+                label_ids.append(-100)
+            previous_word_idx = word_idx
+        labels.append(label_ids)
+    return labels
+
+def make_preprocess(tokenizer):
+    # Only the attributes _make_preprocess reads (no model is loaded)
+    trainer = HFTokenClassificationTrainer.__new__(
+                                        HFTokenClassificationTrainer)
+    trainer.Model = SimpleNamespace(tokenizer=tokenizer, label2id=label2id)
+    trainer.pairLabel = 'pair'
+    trainer.tokensLabel = 'tokens'
+    trainer.tagsLabel = 'tags'
+    return trainer._make_preprocess()
+
+def check(tokenizer, examples):
+    preprocess_function = make_preprocess(tokenizer)
+    output = preprocess_function(examples)
+    pairs = examples.get('pair')
+    expected = loop_alignment(tokenizer(examples['tokens'], pairs,
+                                        truncation=True,
+                                        is_split_into_words=True),
+                              examples['tags'])
+    assert output['labels'] == expected
+    assert output['length'] == [len(ids) for ids in output['input_ids']]
+
+tokenizer = HFTokenizer('bert-base-cased')
+
+def test_split_words_and_string_labels():
+    # Rudolf and reindeer are split into several subwords
+    check(tokenizer, {'tokens': [['Rudolf', 'is', 'a', 'reindeer'],
+                                 ['dogs', 'bark']],
+                      'tags': [['PROPN', 'VERB', 'O', 'NOUN'],
+                               [1, 2]]})
+
+def test_pairs():
+    # Word ids restart at 0 after [SEP]
+    check(tokenizer, {'tokens': [['Rudolf', 'is', 'a', 'reindeer']],
+                      'pair': [['Rudolf', 'flies']],
+                      'tags': [['PROPN', 'VERB', 'O', 'NOUN']]})
+
+def test_truncation():
+    words = ['reindeer', 'Rudolf', 'is'] * 300
+    check(tokenizer, {'tokens': [words],
+                      'tags': [['NOUN', 'PROPN', 'VERB'] * 300]})
+
+if __name__ == '__main__':
+    test_split_words_and_string_labels()
+    test_pairs()
+    test_truncation()
+    print('ok')
@@ -0,0 +1,84 @@
+import sys
+from pathlib import Path
+sys.path.append(str(Path(__file__).parent.parent))
+import os
+import tempfile
+from types import SimpleNamespace
+import datasets
+from src.trainers.Trainer import Trainer
+
+class NamedTokenizer:
+    """ Stands in for HFTokenizer, whose str is only the tokenizer name. """
+    def __init__(self, tokenizername, addPrefixSpace=False):
+        self.tokenizername = tokenizername
+        self.addPrefixSpace = addPrefixSpace
+    def __str__(self):
+        return self.tokenizername
+
+def make_trainer(tmpdir, rows, tokenizer='bert-base-cased'):
+    """ Returns a Trainer with only the attributes used for caching set (no
+    model is loaded). """
+    trainer = Trainer.__new__(Trainer)
+    trainer.cachefpath = os.path.join(tmpdir, 'cache')
+    trainer.Model = SimpleNamespace(tokenizer=tokenizer,
+                                    label2id={'neg': 0, 'pos': 1})
+    trainer.maxSequenceLength = 128
+    trainer.textLabel = 'text'
+    trainer.pairLabel = 'pair'
+    trainer.tokensLabel = 'tokens'
+    trainer.tagsLabel = 'tags'
+
+    # Written once so the same rows keep the same file fingerprint
+    fpath = os.path.join(tmpdir, f"{len(rows)}.tsv")
+    if not os.path.exists(fpath):
+        with open(fpath, 'w') as f:
+            f.write('text\tlabel\n')
+            for text, label in rows:
+                f.write(f"{text}\t{label}\n")
+    split = trainer.load_from_tsv(fpath)
+    trainer.dataset = datasets.DatasetDict({'train': split, 'valid': split})
+    return trainer
+
+rows = [('the man is happy.', 'pos'), ('the man is sad.', 'neg')]
+
+def test_get_cache_path():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trainer = make_trainer(tmpdir, rows)
+        cache_path = trainer.get_cache_path()
+        assert os.path.dirname(cache_path) == trainer.cachefpath
+        # Same data and settings give the same key
+        assert make_trainer(tmpdir, rows).get_cache_path() == cache_path
+        # Different data, tokenizer, or settings give a new key
+        assert make_trainer(tmpdir, rows + [('ok', 'pos')]
+                            ).get_cache_path() != cache_path
+        assert make_trainer(tmpdir, rows, tokenizer='gpt2'
+                            ).get_cache_path() != cache_path
+        # addPrefixSpace changes the token ids for RoBERTa/GPT-2 tokenizers
+        assert make_trainer(tmpdir, rows, 
+                            tokenizer=NamedTokenizer('roberta-base')
+                            ).get_cache_path() != \
+               make_trainer(tmpdir, rows, 
+                            tokenizer=NamedTokenizer('roberta-base', 
+                                                     addPrefixSpace=True)
+                            ).get_cache_path()
+        trainer.maxSequenceLength = 64
+        assert trainer.get_cache_path() != cache_path
+        trainer.cachefpath = None
+        assert trainer.get_cache_path() is None
+
+def test_save_cached_dataset():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        trainer = make_trainer(tmpdir, rows)
+        cache_path = trainer.get_cache_path()
+        trainer.save_cached_dataset(cache_path)
+        # Saving again (e.g., a concurrent run) keeps the existing cache
+        trainer.save_cached_dataset(cache_path)
+        assert os.listdir(trainer.cachefpath) == [os.path.basename(
+                                                            cache_path)]
+        cached = datasets.load_from_disk(cache_path)
+        assert cached['train']['text'] == trainer.dataset['train']['text']
+
+if __name__ == '__main__':
+    test_get_cache_path()
+    test_save_cached_dataset()
+    print('ok')